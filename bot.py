@@ -1,27 +1,52 @@
+import functools
+import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
 import random
 import re
-import textwrap
+import threading
 import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
-from typing import Callable, List, NamedTuple, Tuple
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    DefaultDict,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import dotenv
+import orjson
+import PIL
 import requests
 import telegram
 from PIL import Image, ImageDraw, ImageFont
+from requests.adapters import HTTPAdapter
 from telegram.ext import (
     CommandHandler,
     ConversationHandler,
     Filters,
+    Job,
+    JobQueue,
     MessageHandler,
     Updater,
 )
 from telegram.ext.callbackcontext import CallbackContext
 from telegram.update import Update
+from urllib3.util.retry import Retry
 
 # ---------------------------------------------------------------------------- #
 #                                 Configuration                                #
@@ -36,9 +61,18 @@ dotenv.load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
-FONT_OPTIONS = [f"fonts/{font}" for font in os.listdir("./fonts")]
+# Each render worker holds its own copy of the fonts, at around 60 MB apiece, so
+# their number is capped for hosts that report many cores but give little memory
+RENDER_WORKERS = min(2, os.cpu_count() or 1)
+
+# Enough dispatcher threads to keep every render worker busy, and enough pooled
+# connections to telegram for all of them plus the updater and job queue
+TELEGRAM_WORKERS = max(4, RENDER_WORKERS)
+TELEGRAM_CONNECTION_POOL_SIZE = TELEGRAM_WORKERS + 8
+
+FONT_OPTIONS = tuple(entry.path for entry in os.scandir("fonts") if entry.is_file())
 
-COLOR_OPTIONS = [
+COLOR_OPTIONS = (
     "yellow",
     "gold",
     "springgreen",
@@ -47,24 +81,91 @@ COLOR_OPTIONS = [
     "red",
     "cyan",
     "white",
-]
+)
+
+# Text is wrapped using tiny fonts, since only the proportions matter there
+LINE_BREAK_FONT_SIZE = 1
+LINE_BREAK_TARGET_RATIO = 0.6
+LINE_BREAK_GOOD_RATIO = 0.8
+LINE_BREAK_MAX_STEPS = 5
+MIN_FONT_SIZE = 6
+BASE_FONT_SIZE = 50
+MAX_FONT_SIZE = 200
+
+# "I" must match exactly, while "me" and "my" match in any case
+BLACKLISTED_WORDS = re.compile(r"\bI\b|(?i:\bm[ey]\b)")
 
+IST = timezone(timedelta(hours=5, minutes=30))
+
+QUOTE_API_URL = "http://api.forismatic.com/api/1.0/?method=getQuote&lang=en&format=json"
+BACKGROUND_IMAGE_URL = "http://placeimg.com/400/300/nature"
+# Connect and read timeouts in seconds, so a stalled connection fails fast
+REQUEST_TIMEOUT = (3.05, 5)
+
+BACKGROUNDS_DIRECTORY = "backgrounds"
+BACKGROUND_POOL_SIZE = 50
+
+# Paths of the background images downloaded so far
+BACKGROUNDS: List[str] = []
+BACKGROUND_POOL_LOW = threading.Event()
+
+# A single session keeps connections to the quote and image APIs alive across greetings.
+# Every retry can wait out a full REQUEST_TIMEOUT, so two are enough for a blip
+SESSION = requests.Session()
+SESSION_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(
+        total=2, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+    ),
+)
+SESSION.mount("http://", SESSION_ADAPTER)
+SESSION.mount("https://", SESSION_ADAPTER)
+
+# fetch_quote retries quotes itself within its deadline, so urllib3 must not retry them
+QUOTE_ADAPTER = HTTPAdapter(pool_connections=1, pool_maxsize=8, max_retries=0)
+SESSION.mount(QUOTE_API_URL, QUOTE_ADAPTER)
+
+QUOTE_FETCH_ATTEMPTS = 6
+QUOTE_FETCH_BACKOFF = 0.2
+
+# Stop retrying a quote after this many seconds, even if attempts are left. The
+# last attempt can overrun it by at most its connect timeout
+QUOTE_FETCH_DEADLINE = 10
+
+# Used when Forismatic can't be reached
+FALLBACK_QUOTES = (
+    "Every day is a new beginning.",
+    "The secret of getting ahead is getting started.",
+    "What you do today can improve all your tomorrows.",
+    "Act as if what you do makes a difference. It does.",
+    "Keep your face always toward the sunshine, and shadows will fall behind you.",
+    "Happiness is not something ready made. It comes from your own actions.",
+)
 
-class RegexInfo(NamedTuple):
-    regex: str
-    options: int
+QUOTE_POOL_SIZE = 50
+QUOTE_POOL_REFILL_THRESHOLD = 10
 
+# Quotes fetched ahead of time by refill_quote_pool, so greetings rarely wait on the API
+QUOTE_POOL: Deque[str] = deque(maxlen=QUOTE_POOL_SIZE)
+QUOTE_POOL_LOW = threading.Event()
 
-BLACKLISTED_REGEXES: List[RegexInfo] = [
-    RegexInfo(r"\bI\b", 0),
-    RegexInfo(r"\bm[ey]\b", re.IGNORECASE),
-]
+# Scratch canvas used to measure text without drawing it
+MEASURING_DRAW = ImageDraw.Draw(Image.new("RGB", (1, 1)))
 
-IST = timezone(timedelta(hours=5, minutes=30))
+# Threads used to fetch the quote and background image of a greeting concurrently
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Longest wait for the quote and background of a greeting, together. It leaves room
+# for fetch_quote to overrun its deadline by a whole attempt and still give up first
+GREETING_FETCH_TIMEOUT = QUOTE_FETCH_DEADLINE + sum(REQUEST_TIMEOUT)
 
-updater = Updater(token=TELEGRAM_TOKEN)
-job_queue = updater.job_queue
-dispatcher = updater.dispatcher
+GREETING_ATTEMPTS = 4
+GREETING_RETRY_BACKOFF = 0.2
+GREETING_RETRY_MAX_BACKOFF = 2
+
+# Give up on a greeting after this many seconds, even if attempts are left
+GREETING_DEADLINE = 30
 
 
 # ---------------------------------------------------------------------------- #
@@ -80,21 +181,9 @@ def greet(update: Update, context: CallbackContext):
         update (Update): Update from telegram
         context (CallbackContext): CallbackContext for the update
     """
-    greeting_made = False
-    retries = 0
-    while not greeting_made and retries <= 3:
-        try:
-            quote = get_random_quote()
-            message = ""
-            if context.args is not None:
-                message = " ".join(context.args)
-            if message.strip() == "":
-                message = "Good Morning!"
-            image = make_greeting(quote.strip(), message.strip())
-            greeting_made = True
-        except:
-            print("Oops! Something bad happened. Retrying...")
-    if greeting_made:
+    message = " ".join(context.args or ()).strip() or "Good Morning!"
+    image = create_greeting_with_retries(message)
+    if image is not None:
         context.bot.send_photo(chat_id=update.effective_chat.id, photo=image)
     else:
         context.bot.send_message(
@@ -103,92 +192,302 @@ def greet(update: Update, context: CallbackContext):
         )
 
 
+def create_greeting_with_retries(greeting: str) -> Optional[bytes]:
+    """Create a greeting image, retrying with exponential backoff if it fails.
+    Attempts stop once GREETING_DEADLINE seconds have passed, so a broken API
+    can't hold up a worker thread indefinitely.
+
+    Args:
+        greeting (str): Greeting message to be put on the image
+
+    Returns:
+        Optional[bytes]: The created JPEG image, or None if every attempt failed
+    """
+    deadline = time.monotonic() + GREETING_DEADLINE
+    for attempt in range(1, GREETING_ATTEMPTS + 1):
+        try:
+            return create_greeting(greeting)
+        except Exception:
+            logger.exception(
+                f"Failed to create greeting (attempt {attempt}/{GREETING_ATTEMPTS})"
+            )
+        delay = min(GREETING_RETRY_BACKOFF * 2 ** attempt, GREETING_RETRY_MAX_BACKOFF)
+        if attempt == GREETING_ATTEMPTS or time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
+    return None
+
+
+def create_greeting(greeting: str) -> bytes:
+    """Fetch a quote and a background image concurrently and create a greeting image with them.
+
+    Args:
+        greeting (str): Greeting message to be put on the image
+
+    Returns:
+        bytes: The created JPEG image
+
+    Raises:
+        TimeoutError: If the background takes longer than GREETING_FETCH_TIMEOUT
+            seconds to fetch. A quote that takes that long is replaced by a
+            fallback quote instead
+        BrokenProcessPool: If a rendering process died, in which case the pool
+            is replaced so that the next attempt can succeed
+    """
+    deadline = time.monotonic() + GREETING_FETCH_TIMEOUT
+    quote_future = EXECUTOR.submit(get_random_quote)
+    background_future = EXECUTOR.submit(get_random_background)
+    try:
+        quote = quote_future.result(timeout=GREETING_FETCH_TIMEOUT)
+    except TimeoutError:
+        quote = random.choice(FALLBACK_QUOTES)
+    background = background_future.result(timeout=max(0, deadline - time.monotonic()))
+    process_pool = PROCESS_POOL
+    try:
+        return process_pool.submit(make_greeting, quote, greeting, background).result()
+    except BrokenProcessPool:
+        replace_process_pool(process_pool)
+        raise
+
+
 def get_random_quote() -> str:
-    """Retrieve a random quote from the Forismatic API.
+    """Get a random quote, preferably from the pool of pre-fetched quotes.
 
     Returns:
         str: The retrieved quote
     """
-    quote = ""
-    while quote == "":
-        response = requests.get(
-            "http://api.forismatic.com/api/1.0/?method=getQuote&lang=en&format=json"
-        )
-        if response.status_code != 200:
-            print(f"Error while getting image: {response}")
-            continue
+    try:
+        quote = QUOTE_POOL.popleft()
+    except IndexError:
+        quote = fetch_quote() or random.choice(FALLBACK_QUOTES)
+    if len(QUOTE_POOL) < QUOTE_POOL_REFILL_THRESHOLD:
+        QUOTE_POOL_LOW.set()
+    return quote
+
+
+def refill_quote_pool():
+    """Keep the pool of pre-fetched quotes filled, waking up whenever it runs low."""
+    while True:
+        QUOTE_POOL_LOW.wait()
+        QUOTE_POOL_LOW.clear()
+        while len(QUOTE_POOL) < QUOTE_POOL_SIZE:
+            quote = fetch_quote()
+            if quote is None:
+                # Forismatic is having trouble, try again when the pool next runs low
+                break
+            QUOTE_POOL.append(quote)
+
+
+def fetch_quote() -> Optional[str]:
+    """Retrieve a random quote from the Forismatic API, backing off exponentially
+    between failed attempts until QUOTE_FETCH_DEADLINE seconds have passed.
+    Each attempt's timeouts are cut down to the time left before the deadline.
+
+    Returns:
+        Optional[str]: The retrieved quote, or None if all attempts failed
+    """
+    deadline = time.monotonic() + QUOTE_FETCH_DEADLINE
+    for attempt in range(QUOTE_FETCH_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        timeout = tuple(min(limit, remaining) for limit in REQUEST_TIMEOUT)
         try:
-            response_json = json.loads(response.text.replace("\\'", "'"))
-        except json.decoder.JSONDecodeError as error:
-            print(f"Error while decoding JSON: {response.text}\n{error}")
+            response = SESSION.get(QUOTE_API_URL, timeout=timeout)
+            response.raise_for_status()
+            response_json = decode_quote_response(response)
+            if not isinstance(response_json, dict) or not isinstance(
+                response_json.get("quoteText"), str
+            ):
+                raise ValueError(f"Unexpected quote response: {response_json!r}")
+            quote_text: str = response_json["quoteText"]
+        # Malformed JSON raises a JSONDecodeError, which is a ValueError too
+        except (requests.RequestException, ValueError) as error:
+            logger.warning(f"Error while getting quote: {error!r}")
+            delay = QUOTE_FETCH_BACKOFF * 2 ** attempt
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
             continue
-        quote_text: str = response_json["quoteText"]
-        if contains_no_blacklisted_regexes(quote_text):
-            quote = quote_text
-    return quote
+        # An empty quote counts as a failed attempt, since it can't be fitted
+        quote_text = quote_text.strip()
+        if quote_text and contains_no_blacklisted_words(quote_text):
+            return quote_text
+    return None
+
+
+def decode_quote_response(response: requests.Response) -> Any:
+    """Decode the JSON body of a Forismatic response.
+
+    Args:
+        response (requests.Response): Response from the Forismatic API
+
+    Returns:
+        Any: The decoded response, which should be a dict but isn't checked here
+    """
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        # Forismatic sometimes escapes single quotes, which isn't valid JSON
+        return json.loads(response.text.replace("\\'", "'"))
 
 
-def contains_no_blacklisted_regexes(quote: str) -> bool:
-    """Checks that the given string does not contain any of the blacklisted regex patterns.
+def contains_no_blacklisted_words(quote: str) -> bool:
+    """Checks that the given string does not contain any of the blacklisted words.
 
     Args:
         quote (str): Quote to check
 
     Returns:
-        bool: true if no backlisted patterns are present; false otherwise
+        bool: true if no backlisted words are present; false otherwise
     """
-    return all(
-        re.search(regex_info.regex, quote, regex_info.options) is None
-        for regex_info in BLACKLISTED_REGEXES
-    )
+    return BLACKLISTED_WORDS.search(quote) is None
+
+
+def get_random_background() -> str:
+    """Pick a random background image from the local pool, downloading one
+    if the pool is still empty.
+
+    Returns:
+        str: Path to the background image
+    """
+    if len(BACKGROUNDS) < BACKGROUND_POOL_SIZE:
+        BACKGROUND_POOL_LOW.set()
+    try:
+        return random.choice(BACKGROUNDS)
+    except IndexError:
+        return download_background()
+
+
+def refill_background_pool():
+    """Keep downloading background images until the local pool is full, waking up
+    whenever a greeting finds that it isn't.
+    """
+    while True:
+        BACKGROUND_POOL_LOW.wait()
+        BACKGROUND_POOL_LOW.clear()
+        while len(BACKGROUNDS) < BACKGROUND_POOL_SIZE:
+            try:
+                download_background()
+            except (requests.RequestException, ValueError) as error:
+                # placeimg is having trouble, try again when the next greeting is made
+                logger.warning(f"Error while getting background image: {error}")
+                break
+
+
+def download_background() -> str:
+    """Download a random background image from placeimg into the local pool.
+
+    Returns:
+        str: Path to the downloaded image
+
+    Raises:
+        ValueError: If the response is not an image, such as an error page
+    """
+    response = SESSION.get(BACKGROUND_IMAGE_URL, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    if not is_image(BytesIO(response.content)):
+        raise ValueError(f"{response.url} did not return an image")
+    path = os.path.join(BACKGROUNDS_DIRECTORY, f"{uuid.uuid4().hex}.jpg")
+    # Write to a temporary name first so that a half-written file is never picked
+    with open(f"{path}.part", "wb") as file:
+        file.write(response.content)
+    os.replace(f"{path}.part", path)
+    BACKGROUNDS.append(path)
+    return path
+
+
+def is_image(file: Union[str, BinaryIO]) -> bool:
+    """Check that the given file holds an image that Pillow can fully decode.
+    Decoding catches truncated files too, which Image.verify doesn't for JPEGs.
+
+    Args:
+        file (Union[str, BinaryIO]): Path to the file, or the file itself
 
+    Returns:
+        bool: True if the file is an image, False otherwise
+    """
+    try:
+        with Image.open(file) as image:
+            image.load()
+    except (OSError, SyntaxError):
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=BACKGROUND_POOL_SIZE)
+def load_background(path: str) -> Image.Image:
+    """Decode the background image at the given path, reusing previously decoded images.
+
+    Args:
+        path (str): Path to the background image
 
-def make_greeting(quote: str, greeting: str) -> BytesIO:
+    Returns:
+        Image.Image: The decoded image, to be copied before drawing on it
+    """
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def make_greeting(quote: str, greeting: str, background: str) -> bytes:
     """Create a greeting image with the given quote and greeting.
 
     Args:
         quote (str): Quote to be put on the image
         greeting (str): Greeting message to be put on the image
+        background (str): Path to the background image to put the text on
 
     Returns:
-        BytesIO: A byte stream with the created image
+        bytes: The created JPEG image
     """
-    image = Image.open(
-        requests.get("http://placeimg.com/400/300/nature", stream=True).raw
-    )
+    image = load_background(background).copy()
     draw = ImageDraw.Draw(image)
+    image_width, image_height = image.size
+    half_height = image_height // 2
 
     quote_font_family, greeting_font_family = pick_random_fonts()
+    quote_color, greeting_color = pick_random_colors()
 
     (quote_text, greeting_text) = adjust_line_breaks(
-        quote_font_family, greeting_font_family, quote, greeting, image.width
+        quote_font_family, greeting_font_family, quote, greeting, image_width
     )
-    quote_font = fit_text_in_image(
-        quote_font_family, quote_text, image.height / 2, image.width
+    quote_font, quote_size = fit_text_in_image(
+        quote_font_family, quote_text, half_height, image_width
     )
-    greeting_font = fit_text_in_image(
-        greeting_font_family, greeting_text, image.height / 2, image.width
+    greeting_font, greeting_size = fit_text_in_image(
+        greeting_font_family, greeting_text, half_height, image_width
     )
 
-    draw_text_on_image(
-        draw, quote_text, quote_font, image.height / 2, image.width, 0, 0
-    )
-
-    draw_text_on_image(
-        draw,
-        greeting_text,
-        greeting_font,
-        image.height / 2,
-        image.width,
-        image.height / 2,
-        0,
-    )
+    # The quote is centred in the top half of the image and the greeting in the bottom
+    for text, font, (text_width, text_height), color, top in (
+        (quote_text, quote_font, quote_size, quote_color, 0),
+        (greeting_text, greeting_font, greeting_size, greeting_color, half_height),
+    ):
+        draw.text(
+            (
+                (image_width - text_width) * 0.5,
+                top + ((half_height - text_height) * 0.5),
+            ),
+            text,
+            color,
+            font=font,
+            spacing=10,
+            stroke_width=3,
+            stroke_fill="black",
+        )
 
     bio = BytesIO()
-    bio.name = "image.jpeg"
-    image.save(bio, "JPEG")
-    bio.seek(0)
-    return bio
+    # Skip the Huffman optimisation and progressive passes; Pillow-SIMD speeds this up further
+    image.save(
+        bio,
+        "JPEG",
+        quality=80,
+        optimize=False,
+        progressive=False,
+        subsampling="4:2:0",
+    )
+    return bio.getvalue()
 
 
 def pick_random_fonts() -> Tuple[str, str]:
@@ -197,11 +496,65 @@ def pick_random_fonts() -> Tuple[str, str]:
     Returns:
         Tuple[str, str]: A tuple containing two randomly selected fonts
     """
-    quote_font_family = random.choice(FONT_OPTIONS)
-    greeting_font_family = random.choice(FONT_OPTIONS)
+    quote_font_family, greeting_font_family = random.choices(FONT_OPTIONS, k=2)
     return quote_font_family, greeting_font_family
 
 
+def pick_random_colors() -> Tuple[str, str]:
+    """Randomly picks two text colors from the available options.
+
+    Returns:
+        Tuple[str, str]: A tuple containing two randomly selected colors
+    """
+    quote_color, greeting_color = random.choices(COLOR_OPTIONS, k=2)
+    return quote_color, greeting_color
+
+
+@functools.lru_cache(maxsize=512)
+def load_font(font_family: str, fontsize: int) -> ImageFont.FreeTypeFont:
+    """Load the given font family at the given size, reusing previously loaded fonts.
+
+    Args:
+        font_family (str): Font family
+        fontsize (int): Font size
+
+    Returns:
+        ImageFont.FreeTypeFont: Font object of the given size
+    """
+    return ImageFont.truetype(font_family, fontsize)
+
+
+@functools.lru_cache(maxsize=None)
+def get_line_spacings(font_family: str) -> Dict[int, int]:
+    """Measure the line spacing of the given font family at every size text is
+    fitted at, not counting the extra spacing between lines. This is the same
+    measurement Pillow spaces multiline text with.
+
+    Args:
+        font_family (str): Font family
+
+    Returns:
+        Dict[int, int]: Line spacing in pixels, by font size
+    """
+    return {
+        fontsize: MEASURING_DRAW.textbbox(
+            (0, 0), "A", font=ImageFont.truetype(font_family, fontsize)
+        )[3]
+        for fontsize in range(MIN_FONT_SIZE, MAX_FONT_SIZE + 1)
+    }
+
+
+def preload_fonts():
+    """Load every available font at the sizes every greeting measures text at,
+    and measure their line spacings, so that the first greetings don't pay for
+    parsing the font files.
+    """
+    for font_family in FONT_OPTIONS:
+        load_font(font_family, LINE_BREAK_FONT_SIZE)
+        load_font(font_family, BASE_FONT_SIZE)
+        get_line_spacings(font_family)
+
+
 def adjust_line_breaks(
     quote_font_family: str,
     greeting_font_family: str,
@@ -221,37 +574,93 @@ def adjust_line_breaks(
     Returns:
         Tuple[str, str]: A tuple containing quote and greeting texts
     """
-    fontsize = 1
-    quote_text = quote
-    greeting_text = greeting
-    quote_font = ImageFont.truetype(quote_font_family, fontsize)
-    greeting_font = ImageFont.truetype(greeting_font_family, fontsize)
+    quote_font = load_font(quote_font_family, LINE_BREAK_FONT_SIZE)
+    greeting_font = load_font(greeting_font_family, LINE_BREAK_FONT_SIZE)
 
-    while (
-        not 0.5
-        < text_dimensions_ratio(quote_font, greeting_font, quote_text, greeting_text)
-        < 2
-    ) and width > 1:
-        width = width - 1
-        quote_text = wrap_text(quote_font, quote, width)
-        greeting_text = wrap_text(greeting_font, greeting, width)
+    def wrap(wrap_width: float) -> Tuple[str, str]:
+        return (
+            wrap_text(quote_font, quote, wrap_width),
+            wrap_text(greeting_font, greeting, wrap_width),
+        )
 
-    return quote_text, greeting_text
+    def measure(texts: Tuple[str, str]) -> float:
+        return text_dimensions_ratio(quote_font, greeting_font, *texts)
 
+    texts = (quote, greeting)
+    ratio = measure(texts)
+    if 0.5 < ratio < 2:
+        return texts
 
-def wrap_text(font: ImageFont, text: str, width: int) -> str:
-    """Wraps the given text according to the font and width provided.
+    # Wrapping narrower than the unwrapped text is the only way to change its shape
+    width = min(
+        width, max(quote_font.getlength(quote), greeting_font.getlength(greeting))
+    )
+    # The ratio scales with about width ** exponent. Wrapping at a width w makes the
+    # text about 1 / w as tall, so -2 is the first guess; every wrap refines it.
+    exponent = -2.0
+    best_texts, best_ratio = None, 2.0
+    for _ in range(LINE_BREAK_MAX_STEPS):
+        previous_width, previous_ratio = width, ratio
+        width = max(1, width * (LINE_BREAK_TARGET_RATIO / ratio) ** (1 / exponent))
+        texts = wrap(width)
+        ratio = measure(texts)
+        # Prefer the widest acceptable layout, as that fills the image best
+        if 0.5 < ratio < best_ratio:
+            best_texts, best_ratio = texts, ratio
+            if ratio <= LINE_BREAK_GOOD_RATIO:
+                break
+        if ratio != previous_ratio and width != previous_width:
+            ratio_change = math.log(ratio / previous_ratio)
+            observed = ratio_change / math.log(width / previous_width)
+            if observed < 0:
+                exponent = observed
+
+    return best_texts or texts
+
+
+def wrap_text(font: ImageFont, text: str, width: float) -> str:
+    """Wraps the given text greedily so that no line is wider than the given width,
+    unless it is a single word wider than that by itself.
 
     Args:
         font (ImageFont): Font being used
         text (str): Text to wrap
-        width (int): Width in which text needs to be wrapped
+        width (float): Width in which text needs to be wrapped
 
     Returns:
         str: Wrapped text
     """
-    w = (len(text) * width) // font.getsize(text)[0]
-    return "\n".join(textwrap.wrap(text, w))
+    space_width = get_text_width(font.path, font.size, " ")
+    lines = []
+    line: List[str] = []
+    line_width = 0.0
+    for word in text.split():
+        word_width = get_text_width(font.path, font.size, word)
+        if line and line_width + space_width + word_width > width:
+            lines.append(" ".join(line))
+            line, line_width = [], 0.0
+        if line:
+            line_width += space_width
+        line.append(word)
+        line_width += word_width
+    if line:
+        lines.append(" ".join(line))
+    return "\n".join(lines)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_text_width(font_family: str, fontsize: int, text: str) -> float:
+    """Get the advance width of the given single-line text, reusing previous measurements.
+
+    Args:
+        font_family (str): Font family
+        fontsize (int): Font size
+        text (str): Text to measure
+
+    Returns:
+        float: Width of the text
+    """
+    return load_font(font_family, fontsize).getlength(text)
 
 
 def text_dimensions_ratio(
@@ -268,19 +677,38 @@ def text_dimensions_ratio(
     Returns:
         float: Ratio of total height to width of the text
     """
-    return (
-        quote_font.getsize_multiline(quote_text)[1]
-        + greeting_font.getsize_multiline(greeting_text)[1]
-    ) / (
-        quote_font.getsize_multiline(quote_text)[0]
-        + greeting_font.getsize_multiline(greeting_text)[0]
+    quote_width, quote_height = get_multiline_text_size(quote_font, quote_text)
+    greeting_width, greeting_height = get_multiline_text_size(
+        greeting_font, greeting_text
+    )
+    return (quote_height + greeting_height) / (quote_width + greeting_width)
+
+
+def get_multiline_text_size(
+    font: ImageFont, text: str, spacing: int = 4
+) -> Tuple[int, int]:
+    """Measure the size of the given multiline text from its bounding box.
+
+    Args:
+        font (ImageFont): Font used for the text
+        text (str): Text to measure
+        spacing (int, optional): Number of pixels between lines. Defaults to 4.
+
+    Returns:
+        Tuple[int, int]: Width and height of the text
+    """
+    left, top, right, bottom = MEASURING_DRAW.multiline_textbbox(
+        (0, 0), text, font=font, spacing=spacing
     )
+    return right - left, bottom - top
 
 
+@functools.lru_cache(maxsize=256)
 def fit_text_in_image(
     font_family: str, text: str, height: int, width: int
-) -> ImageFont:
-    """Adjust the font such that the text fits in the image.
+) -> Tuple[ImageFont.FreeTypeFont, Tuple[int, int]]:
+    """Adjust the font such that the text fits in the image. Results are cached,
+    since the same greeting is often fitted in the same font many times over.
 
     Args:
         font_family (str): Font family
@@ -289,57 +717,61 @@ def fit_text_in_image(
         width (int): Width
 
     Returns:
-        ImageFont: Font object with appropriate sizing
+        Tuple[ImageFont.FreeTypeFont, Tuple[int, int]]: Font object with
+            appropriate sizing, and the dimensions of the text in that font
     """
-    fontsize = 10
-    font = ImageFont.truetype(font_family, fontsize)
-    while font.getsize_multiline(text, spacing=10)[0] < 0.9 * width:
-        fontsize += 1
-        font = ImageFont.truetype(font_family, fontsize)
-
-    while font.getsize_multiline(text, spacing=10)[0] > 0.9 * width:
-        fontsize -= 1
-        font = ImageFont.truetype(font_family, fontsize)
-
-    while font.getsize_multiline(text, spacing=10)[1] > 0.8 * height:
-        fontsize -= 1
-        font = ImageFont.truetype(font_family, fontsize)
-    return font
-
-
-def draw_text_on_image(
-    draw: ImageDraw,
-    text: str,
-    font: ImageFont,
-    height: int,
-    width: int,
-    heigh_offset: int,
-    width_offset: int,
-):
-    """Draw given text on the given image.
-
-    Args:
-        draw (ImageDraw): The ImageDraw object using which text will be drawn
-        text (str): Text to draw on the image
-        font (ImageFont): Font to be used
-        height (int): Height of the image
-        width (int): Width of the image
-        heigh_offset (int): Height offset from the centre
-        width_offset (int): Width offset from the centre
-    """
-    w, h = draw.multiline_textsize(text, font, spacing=10)
-    left = width_offset + ((width - w) * 0.5)
-    top = heigh_offset + ((height - h) * 0.5)
-
-    draw.text(
-        (left, top),
-        text,
-        random.choice(COLOR_OPTIONS),
-        font=font,
-        spacing=10,
-        stroke_width=3,
-        stroke_fill="black",
+    max_width = 0.9 * width
+    max_height = 0.8 * height
+    sizes = {}
+
+    def fits(fontsize: int) -> bool:
+        font = load_font(font_family, fontsize)
+        sizes[fontsize] = get_multiline_text_size(font, text, spacing=10)
+        text_width, text_height = sizes[fontsize]
+        return text_width <= max_width and text_height <= max_height
+
+    # Text width scales roughly linearly with the font size, and so does the height
+    # once the gaps between lines are taken out, since those come from the font's
+    # line spacing table and a fixed number of pixels. So estimate the largest size
+    # that fits from a single measurement and then correct it
+    base_width, base_height = get_multiline_text_size(
+        load_font(font_family, BASE_FONT_SIZE), text, spacing=10
     )
+    line_spacings = get_line_spacings(font_family)
+    line_gaps = text.count("\n")
+    base_extent = base_height - line_gaps * (line_spacings[BASE_FONT_SIZE] + 10)
+
+    def estimated_height(fontsize: int) -> float:
+        return (
+            line_gaps * (line_spacings[fontsize] + 10)
+            + base_extent * fontsize / BASE_FONT_SIZE
+        )
+
+    fontsize = int(BASE_FONT_SIZE * max_width / base_width)
+    fontsize = min(max(fontsize, MIN_FONT_SIZE), MAX_FONT_SIZE)
+    # Estimating the height is only arithmetic, so search the sizes for the tallest
+    # estimate that fits
+    if estimated_height(fontsize) > max_height:
+        low, high = MIN_FONT_SIZE, fontsize - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimated_height(mid) <= max_height:
+                low = mid
+            else:
+                high = mid - 1
+        fontsize = low
+
+    # Only rounding separates the estimate from the answer, which leaves it a size
+    # or two off at most, so walk from it one size at a time
+    if fits(fontsize):
+        while fontsize < MAX_FONT_SIZE and fits(fontsize + 1):
+            fontsize += 1
+    else:
+        while fontsize > MIN_FONT_SIZE:
+            fontsize -= 1
+            if fits(fontsize):
+                break
+    return load_font(font_family, fontsize), sizes[fontsize]
 
 
 # ---------------------------------------------------------------------------- #
@@ -348,6 +780,44 @@ def draw_text_on_image(
 
 MESSAGE, INTERVAL, FIRST, LAST, CREATOR = range(5)
 
+# Seconds for which a greeting listed by /list can be cancelled
+LIST_CANCEL_TIMEOUT = 15
+
+# Scheduled greetings by chat ID and then by job name, so that a chat's greetings
+# can be found without going through every job in the queue
+SCHEDULED_JOBS: DefaultDict[int, Dict[str, Job]] = defaultdict(dict)
+
+# Sequence numbers that keep the names of scheduled jobs unique
+JOB_SEQUENCE = itertools.count()
+
+# Reads the job name back from the first line of a greeting listed by /list
+SCHEDULE_ID_PATTERN = re.compile(r"Schedule ID: (\S+)\s")
+
+# The yyyy-mm-dd HH:MM:SS format that schedule start and end times are given in,
+# allowing single digits where strptime does
+DATETIME_PATTERN = re.compile(
+    r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2}) ([0-9]{1,2}):([0-9]{1,2}):([0-9]{1,2})"
+)
+
+
+def parse_ist_datetime(text: str) -> datetime:
+    """Parse a yyyy-mm-dd HH:MM:SS datetime in IST. This does the same job as
+    datetime.strptime for this one format, without its per-call overhead.
+
+    Args:
+        text (str): Datetime to parse
+
+    Returns:
+        datetime: The parsed timezone-aware datetime
+
+    Raises:
+        ValueError: If the text is not a valid datetime in the expected format
+    """
+    match = DATETIME_PATTERN.fullmatch(text)
+    if match is None:
+        raise ValueError(f"'{text}' does not match the yyyy-mm-dd HH:MM:SS format")
+    return datetime(*map(int, match.groups()), tzinfo=IST)
+
 
 def get_callback(message: str, chat_id: int) -> Callable[["CallbackContext"], None]:
     """Get the callback for scheduled greetings.
@@ -366,20 +836,11 @@ def get_callback(message: str, chat_id: int) -> Callable[["CallbackContext"], No
         Args:
             context (CallbackContext): CallbackContext for the update
         """
-        greeting_made = False
-        retries = 0
-        while not greeting_made and retries <= 3:
-            try:
-                quote = get_random_quote()
-                image = make_greeting(quote.strip(), message.strip())
-                greeting_made = True
-            except:
-                print("Oops! Something bad happened. Retrying...")
-                retries += 1
-        if greeting_made:
+        image = create_greeting_with_retries(message)
+        if image is not None:
             context.bot.send_photo(chat_id=chat_id, photo=image)
         else:
-            print(f"Skipping scheduled message after {retries} retries.")
+            logger.warning(f"Skipping scheduled message for chat {chat_id}.")
 
     return schedule_callback
 
@@ -417,7 +878,7 @@ def schedule_message(update: Update, context: CallbackContext) -> int:
     Returns:
         int: The next state in the conversation
     """
-    context.user_data[MESSAGE] = update.message.text
+    context.user_data[MESSAGE] = update.message.text.strip()
     update.message.reply_text(
         "Hello Respected Sir/Madamji,\n\nThanks for sending me the greeting message. "
         + "I also need *the interval (in seconds)* at which you want to send the above-mentioned "
@@ -465,8 +926,7 @@ def schedule_first(update: Update, context: CallbackContext) -> int:
         date_object = None
     else:
         try:
-            date_object = datetime.strptime(update.message.text, "%Y-%m-%d %H:%M:%S")
-            date_object = date_object.replace(tzinfo=IST)
+            date_object = parse_ist_datetime(update.message.text)
             if date_object < datetime.now(IST):
                 update.message.reply_text(
                     "Hello Respected Sir/Madamji,\n\nI am only a simple bot. I cannot do this time-travel stuffs. "
@@ -508,13 +968,13 @@ def schedule_last(update: Update, context: CallbackContext) -> int:
     Returns:
         int: The next state in the conversation
     """
+    now = datetime.now(IST)
     if update.message.text.lower() == "never":
         date_object = None
     else:
         try:
-            date_object = datetime.strptime(update.message.text, "%Y-%m-%d %H:%M:%S")
-            date_object = date_object.replace(tzinfo=IST)
-            if context.user_data[FIRST] is None and date_object < datetime.now(IST):
+            date_object = parse_ist_datetime(update.message.text)
+            if context.user_data[FIRST] is None and date_object < now:
                 update.message.reply_text(
                     "Hello Respected Sir/Madamji,\n\nI am only a simple bot. I cannot do this time-travel stuffs. "
                     + "So kindly give me a date and time in the future only. "
@@ -566,7 +1026,7 @@ def schedule_last(update: Update, context: CallbackContext) -> int:
         + "At your service,\nGoodMorningBot",
         parse_mode="markdown",
     )
-    context.job_queue.run_repeating(
+    job = context.job_queue.run_repeating(
         callback=get_callback(context.user_data[MESSAGE], update.effective_chat.id),
         interval=context.user_data[INTERVAL],
         first=context.user_data[FIRST],
@@ -577,11 +1037,12 @@ def schedule_last(update: Update, context: CallbackContext) -> int:
             INTERVAL: context.user_data[INTERVAL],
             FIRST: context.user_data[FIRST]
             if context.user_data[FIRST] is not None
-            else datetime.now(IST),
+            else now,
             LAST: context.user_data[LAST],
         },
-        name=f"{update.effective_chat.id}_{time.time()}",
+        name=f"{update.effective_chat.id}_{next(JOB_SEQUENCE)}",
     )
+    SCHEDULED_JOBS[update.effective_chat.id][job.name] = job
 
     return ConversationHandler.END
 
@@ -616,11 +1077,7 @@ def get_scheduled_messages(update: Update, context: CallbackContext):
     Returns:
         int: The next state in the conversation.
     """
-    jobs = [
-        job
-        for job in job_queue.jobs()
-        if job.name.startswith(str(update.effective_chat.id))
-    ]
+    jobs = get_chat_jobs(context.job_queue, update.effective_chat.id)
     if len(jobs) > 0:
         update.message.reply_text(
             "Hello Respected Sir/Madamji,\n\nPlease find the list of greetings that have been scheduled "
@@ -637,16 +1094,16 @@ def get_scheduled_messages(update: Update, context: CallbackContext):
                 + f"{job.context[LAST].strftime('%d %b, %Y at %H:%M:%S') if job.context[LAST] is not None else 'Ad infinitum'}"
                 + "\n\n"
             )
-            footer = "<i>Reply to this with <code>cancel</code> in the next 15 seconds to cancel this schedule.</i>"
+            footer = f"<i>Reply to this with <code>cancel</code> in the next {LIST_CANCEL_TIMEOUT} seconds to cancel this schedule.</i>"
             sent_message = context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=message + footer,
                 parse_mode="HTML",
             )
-            job_queue.run_repeating(
-                edit_time_left,
-                1,
-                context={"message": sent_message, "text": message, "time_left": 14},
+            context.job_queue.run_once(
+                remove_cancel_footer,
+                LIST_CANCEL_TIMEOUT,
+                context={"message": sent_message, "text": message},
                 name=str(sent_message.message_id),
             )
         return 1
@@ -658,30 +1115,34 @@ def get_scheduled_messages(update: Update, context: CallbackContext):
         return ConversationHandler.END
 
 
-def edit_time_left(context: CallbackContext):
-    """Callback to edit the time left to cancel a schedule in the message generated by /list.
+def get_chat_jobs(job_queue: JobQueue, chat_id: int) -> List[Job]:
+    """Get the scheduled greetings of the given chat that are still pending,
+    forgetting the ones that have finished or been cancelled.
+
+    Args:
+        job_queue (JobQueue): The job queue the greetings were scheduled on
+        chat_id (int): Chat to get the scheduled greetings of
+
+    Returns:
+        List[Job]: The pending scheduled greetings
+    """
+    chat_jobs = SCHEDULED_JOBS[chat_id]
+    for name, job in list(chat_jobs.items()):
+        if job.removed or job_queue.scheduler.get_job(job.job.id) is None:
+            del chat_jobs[name]
+    return list(chat_jobs.values())
+
+
+def remove_cancel_footer(context: CallbackContext):
+    """Callback to remove the cancel instructions from a message generated by /list
+    once the time to cancel has run out.
 
     Args:
         context (CallbackContext): CallbackContext for the update
     """
     message: telegram.Message = context.job.context["message"]
     text: str = context.job.context["text"]
-    time_left: int = context.job.context["time_left"]
-    if time_left is None:
-        footer = f"<i>This schedule has been cancelled.</i>"
-        message.edit_text(text + footer, parse_mode="HTML")
-        context.job.schedule_removal()
-        return
-    if time_left == 0:
-        message.edit_text(text, parse_mode="HTML")
-    else:
-        footer = f"<i>Reply to this with <code>cancel</code> in the next {time_left} seconds to cancel this schedule.</i>"
-        message.edit_text(text + footer, parse_mode="HTML")
-    time_left -= 1
-    if time_left == -1:
-        context.job.schedule_removal()
-    else:
-        context.job.context["time_left"] = time_left
+    message.edit_text(text, parse_mode="HTML")
 
 
 def handle_schedule_cancel(update: Update, context: CallbackContext) -> int:
@@ -695,15 +1156,19 @@ def handle_schedule_cancel(update: Update, context: CallbackContext) -> int:
         int: The next state in the conversation (end).
     """
     message = update.message.reply_to_message
-    job_name = re.search("^Schedule ID: ([^\s]+)\s", message.text).group(1)
+    job_name = SCHEDULE_ID_PATTERN.match(message.text).group(1)
     print(f"Cancelling job: {job_name}")
-    job_queue.get_jobs_by_name(job_name)[0].schedule_removal()
+    SCHEDULED_JOBS[update.effective_chat.id].pop(job_name).schedule_removal()
     update.message.reply_text(
         "Hello Respected Sir/Madamji,\n\nAs requested by yourself, I have cancelled "
         + "that scheduled greeting.\n\nThanks and regards,\nGoodMorningBot"
     )
-    for job in job_queue.get_jobs_by_name(str(message.message_id)):
-        job.context["time_left"] = None
+    for job in context.job_queue.get_jobs_by_name(str(message.message_id)):
+        job.schedule_removal()
+        footer = "<i>This schedule has been cancelled.</i>"
+        job.context["message"].edit_text(
+            job.context["text"] + footer, parse_mode="HTML"
+        )
     return ConversationHandler.END
 
 
@@ -721,7 +1186,7 @@ get_schedule_command_handler = ConversationHandler(
             handle_schedule_cancel,
         )
     ],
-    conversation_timeout=15,
+    conversation_timeout=LIST_CANCEL_TIMEOUT,
 )
 
 schedule_command_handler = ConversationHandler(
@@ -735,7 +1200,7 @@ schedule_command_handler = ConversationHandler(
         ],
         INTERVAL: [
             MessageHandler(
-                Filters.regex("^[0-9]+$"),
+                Filters.regex(re.compile(r"^[0-9]+$")),
                 schedule_interval,
             )
         ],
@@ -765,14 +1230,94 @@ schedule_command_handler = ConversationHandler(
     fallbacks=[CommandHandler("cancel", schedule_cancel)],
 )
 
-dispatcher.add_handler(greet_command_handler)
-dispatcher.add_handler(get_schedule_command_handler)
-dispatcher.add_handler(schedule_command_handler)
 
 # ---------------------------------------------------------------------------- #
 #                              Bot start and stop                              #
 # ---------------------------------------------------------------------------- #
 
-updater.start_polling(clean=True)
 
-updater.idle()
+def create_process_pool() -> ProcessPoolExecutor:
+    """Create a pool of processes to render greetings in parallel, outside the
+    dispatcher threads. Workers are spawned, not forked, since the bot is
+    multithreaded by the time they start. Every worker is started, and has its
+    fonts preloaded, before the pool is returned, so greetings never wait on it.
+
+    Returns:
+        ProcessPoolExecutor: The new process pool
+    """
+    process_pool = ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=preload_fonts,
+    )
+    # Workers are only spawned when tasks are submitted and none of them is idle,
+    # so submitting one task per worker at once starts them all
+    warm_ups = [process_pool.submit(preload_fonts) for _ in range(RENDER_WORKERS)]
+    for warm_up in warm_ups:
+        warm_up.result()
+    return process_pool
+
+
+def replace_process_pool(broken_pool: ProcessPoolExecutor):
+    """Replace a process pool that can no longer be used because one of its
+    workers died. Greetings that fail at the same time all report the same broken
+    pool, so it is only replaced once.
+
+    Args:
+        broken_pool (ProcessPoolExecutor): The pool that broke
+    """
+    global PROCESS_POOL
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is broken_pool:
+            logger.warning("A rendering process died, restarting the process pool")
+            PROCESS_POOL = create_process_pool()
+            broken_pool.shutdown(wait=False)
+
+
+# Created by main rather than on import, since every spawned worker imports this module
+PROCESS_POOL: Optional[ProcessPoolExecutor] = None
+PROCESS_POOL_LOCK = threading.Lock()
+
+
+def main():
+    """Register the handlers, start the quote, background and process pools and poll
+    telegram for updates.
+    """
+    global PROCESS_POOL
+    logger.info(f"Rendering greetings with Pillow {PIL.__version__}")
+    updater = Updater(
+        token=TELEGRAM_TOKEN,
+        workers=TELEGRAM_WORKERS,
+        request_kwargs={"con_pool_size": TELEGRAM_CONNECTION_POOL_SIZE},
+    )
+    dispatcher = updater.dispatcher
+    dispatcher.add_handler(greet_command_handler)
+    dispatcher.add_handler(get_schedule_command_handler)
+    dispatcher.add_handler(schedule_command_handler)
+
+    QUOTE_POOL_LOW.set()
+    threading.Thread(target=refill_quote_pool, name="quote-pool", daemon=True).start()
+
+    os.makedirs(BACKGROUNDS_DIRECTORY, exist_ok=True)
+    for entry in os.scandir(BACKGROUNDS_DIRECTORY):
+        if not entry.name.endswith(".jpg"):
+            continue
+        # Drop anything that isn't an image, so it can't break every greeting
+        if is_image(entry.path):
+            BACKGROUNDS.append(entry.path)
+        else:
+            os.remove(entry.path)
+    BACKGROUND_POOL_LOW.set()
+    threading.Thread(
+        target=refill_background_pool, name="background-pool", daemon=True
+    ).start()
+
+    PROCESS_POOL = create_process_pool()
+
+    updater.start_polling(clean=True)
+
+    updater.idle()
+
+
+if __name__ == "__main__":
+    main()